@@ -6,27 +6,31 @@ import traceback
 import sys
 import getopt
 from itertools import chain
+from functools import partial
 from random import sample
+from multiprocessing.pool import ThreadPool
+from threading import local
 
-from tlsfuzzer.runner import Runner
+from tlsfuzzer.runner import Runner, ConnectionState
 from tlsfuzzer.messages import Connect, ClientHelloGenerator, \
         ClientKeyExchangeGenerator, ChangeCipherSpecGenerator, \
         FinishedGenerator, ApplicationDataGenerator, AlertGenerator, \
-        fuzz_message
+        RawMessageGenerator, substitute_and_xor
 from tlsfuzzer.expect import ExpectServerHello, ExpectCertificate, \
         ExpectServerHelloDone, ExpectChangeCipherSpec, ExpectFinished, \
         ExpectAlert, ExpectApplicationData, ExpectClose, \
         ExpectServerKeyExchange
 
 from tlslite.constants import CipherSuite, AlertLevel, AlertDescription, \
-        GroupName, ExtensionType, SignatureAlgorithm, HashAlgorithm
+        GroupName, ExtensionType, SignatureAlgorithm, HashAlgorithm, \
+        ContentType
 from tlslite.extensions import SupportedGroupsExtension, \
         SignatureAlgorithmsExtension, SignatureAlgorithmsCertExtension
 from tlsfuzzer.utils.lists import natural_sort_keys
 from tlsfuzzer.helpers import AutoEmptyExtension
 
 
-version = 4
+version = 5
 
 
 def help_msg():
@@ -51,9 +55,147 @@ def help_msg():
     print(" -C ciph        Use specified ciphersuite. Either numerical value or")
     print("                IETF name.")
     print(" -M | --ems     Advertise support for Extended Master Secret")
+    print(" --jobs num     run 'num' conversations in parallel, 1 by default")
+    print("                (\"sanity\" tests are always run on their own)")
     print(" --help         this message")
 
 
+def client_hello_bytes(ciphers, extensions):
+    """Return encoded Client Hello as sent in a new connection."""
+    hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
+                                     extensions=extensions)
+    return hello_gen.generate(ConnectionState()).write()
+
+
+def expect_fatal_alert(description):
+    """
+    Create nodes expecting a fatal alert and closure of the connection.
+
+    The nodes don't keep any per-connection state, so they can be shared
+    by many conversations. The description is passed as a tuple, so that
+    ExpectAlert doesn't need to convert it, modifying the shared node,
+    while processing the alert.
+    """
+    node = ExpectAlert(level=AlertLevel.fatal, description=(description,))
+    node.add_child(ExpectClose())
+    return node
+
+
+def fuzzed_hello_conversation(host, port, hello, expected,
+                              substitutions=None, xors=None):
+    """
+    Create conversation sending a malformed Client Hello to the server.
+
+    The message is created by modifying a copy of the encoded Client Hello
+    'hello', so that it doesn't have to be created for every conversation.
+    'expected' are the nodes (shared with other conversations) processing
+    the server reaction.
+    """
+    conversation = Connect(host, port)
+    node = conversation
+    data = substitute_and_xor(bytearray(hello), substitutions, xors)
+    node = node.add_child(RawMessageGenerator(ContentType.handshake, data))
+    node.add_child(expected)
+    return conversation
+
+
+class ThreadOutput(object):
+    """
+    Output stream that can collect writes of selected threads.
+
+    Writes of threads that started a capture are stored until the capture
+    is finished, writes of other threads are passed to the wrapped stream.
+    """
+
+    def __init__(self, stream):
+        """Wrap the stream."""
+        self.stream = stream
+        self._local = local()
+
+    def start_capture(self):
+        """Start collecting writes of the current thread."""
+        self._local.buffer = []
+
+    def stop_capture(self):
+        """Stop collecting writes of the current thread, return them."""
+        data = "".join(self._local.buffer)
+        self._local.buffer = None
+        return data
+
+    def write(self, data):
+        """Store data if the thread captures writes, write it otherwise."""
+        buf = getattr(self._local, "buffer", None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.append(data)
+
+    def __getattr__(self, name):
+        """Pass other methods to the wrapped stream."""
+        return getattr(self.stream, name)
+
+
+def run_conversation(test, output=None):
+    """
+    Execute single conversation.
+
+    Returns name of the conversation, if it passed, the raised exception
+    and its formatted traceback. When 'output' is provided, the text
+    printed by the Runner is captured in it, and returned as the last
+    element.
+    """
+    c_name, c_test = test
+    runner = Runner(c_test)
+
+    res, exception, exc_trace = True, None, None
+    if output is not None:
+        output.start_capture()
+    try:
+        runner.run()
+    except Exception as exp:
+        res, exception, exc_trace = False, exp, traceback.format_exc()
+    finally:
+        printed = output.stop_capture() if output is not None else None
+    return c_name, res, exception, exc_trace, printed
+
+
+def run_conversations_serial(tests):
+    """
+    Execute conversations one by one.
+
+    The name of the conversation is printed before it is executed, so it's
+    visible which one is running and the Runner diagnostics follow it.
+    """
+    for test in tests:
+        print("{0} ...".format(test[0]))
+        yield run_conversation(test)[:4]
+
+
+def run_conversations_parallel(tests, jobs):
+    """
+    Execute conversations using 'jobs' threads.
+
+    Results are returned as soon as the conversations finish, so a
+    conversation waiting for a timeout doesn't hold back reporting of the
+    other ones. The name of the conversation is printed once it finishes,
+    followed by the diagnostics the Runner printed while executing it.
+    The execution starts only once the first result is requested.
+    """
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    pool = ThreadPool(jobs)
+    try:
+        for result in pool.imap_unordered(
+                partial(run_conversation, output=output), tests):
+            print("{0} ...".format(result[0]))
+            output.stream.write(result[4])
+            yield result[:4]
+    finally:
+        pool.terminate()
+        pool.join()
+        sys.stdout = output.stream
+
+
 def main():
     host = "localhost"
     port = 4433
@@ -64,9 +206,11 @@ def main():
     dhe = False
     ciphers = None
     ems = False
+    jobs = 1
 
     argv = sys.argv[1:]
-    opts, args = getopt.getopt(argv, "h:p:e:x:X:n:dC:M", ["help", "ems"])
+    opts, args = getopt.getopt(argv, "h:p:e:x:X:n:dC:M",
+                               ["help", "ems", "jobs="])
     for opt, arg in opts:
         if opt == '-h':
             host = arg
@@ -95,6 +239,10 @@ def main():
                     ciphers = [int(arg)]
         elif opt == '-M' or opt == '--ems':
             ems = True
+        elif opt == '--jobs':
+            jobs = int(arg)
+            if jobs < 1:
+                raise ValueError("--jobs needs to be a positive integer")
         elif opt == '--help':
             help_msg()
             sys.exit(0)
@@ -201,157 +349,129 @@ def main():
     node.next_sibling = ExpectClose()
     conversations["sanity w/ext"] = conversation
 
-    # test different message types for client hello
-    for i in range(1, 0x100):
-        conversation = Connect(host, port)
-        node = conversation
-        hello_gen = ClientHelloGenerator(
-            ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV],
-            version=(3, 3),
-            extensions=ext)
-        node = node.add_child(fuzz_message(hello_gen, xors={0: i}))
-        node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                          description=AlertDescription.unexpected_message))
-        node = node.add_child(ExpectClose())
-        conversations["Client Hello type fuzz to {0}".format(1 ^ i)] = conversation
-
-    # test invalid sizes for session ID length
+    def is_regular(name):
+        """Check if the test can be picked for execution."""
+        if run_only:
+            return name in run_only
+        return name != 'sanity' and name not in run_exclude
+
+    # the fuzzed conversations are only created after sampling, as
+    # there are thousands of them and usually just a subset is run,
+    # the tests that can't be picked are not registered at all;
+    # the sanity conversations are already created, just wrap them so that
+    # they can be sampled together with the fuzzed ones
+    conversation_factories = [(k, partial(conversations.__getitem__, k))
+                              for k in conversations if is_regular(k)]
+    skipped = len(run_exclude.intersection(conversations))
+    # all fuzzed conversations send one of those two Client Hello messages,
+    # so encode them just once
+    hello_scsv = client_hello_bytes(
+        ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV], ext)
+    hello_ext = client_hello_bytes(ciphers, ext_renego_info)
+
+    # lengths that make the Client Hello with extensions a valid
+    # extension-less Client Hello
+    if dhe:
+        valid_ciphers_len = (56,) if ems else (60,)
+        valid_compression_len = (66,) if ems else (62,)
+    else:
+        valid_ciphers_len = ()
+        valid_compression_len = (12,) if ems else (8,)
+
+    # test different values of single bytes of Client Hello: message type
+    # and lengths of fields
+    # message types and session ID lengths are tested with all values,
+    # the other lengths only with the ones around the byte boundaries and
+    # around the correct length, as the other ones make the server behave
+    # the same way
+    all_bytes = range(0, 0x100)
+    boundary_lengths = None
+    # (name, Client Hello, position, value xored with to get the value in
+    # the name (or None to substitute the byte), values to send in the byte
+    # (None for boundary_lengths), expected alert, values in name to skip)
+    single_byte_fuzz = [
+        ("Client Hello type fuzz to {0}", hello_scsv, 0, 1, all_bytes,
+         AlertDescription.unexpected_message, ())]
     if not ext:
-        for i in range(1, 0x100):
-            conversation = Connect(host, port)
-            node = conversation
-            hello_gen = ClientHelloGenerator(
-                ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV],
-                version=(3, 3), extensions=ext)
-            node = node.add_child(fuzz_message(hello_gen, substitutions={38: i}))
-            node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                              description=AlertDescription.decode_error))
-            node = node.add_child(ExpectClose())
-            conversations["session ID len fuzz to {0}".format(i)] = conversation
-
-    for i in range(1, 0x100):
-        conversation = Connect(host, port)
-        node = conversation
-        hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                         extensions=ext_renego_info)
-        node = node.add_child(fuzz_message(hello_gen, substitutions={38: i}))
-        node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                          description=AlertDescription.decode_error))
-        node = node.add_child(ExpectClose())
-        conversations["session ID len fuzz to {0} w/ext".format(i)] = conversation
-
-
-    # test invalid sizes for cipher suites length
+        single_byte_fuzz += [
+            ("session ID len fuzz to {0}", hello_scsv, 38, None, all_bytes,
+             AlertDescription.decode_error, ()),
+            ("cipher suites len fuzz to {0}", hello_scsv, 40, 4,
+             boundary_lengths, AlertDescription.decode_error, ()),
+            ("compression methods len fuzz to {0}", hello_scsv, 45, 1,
+             boundary_lengths, AlertDescription.decode_error, ())]
+    single_byte_fuzz += [
+        ("session ID len fuzz to {0} w/ext", hello_ext, 38, None, all_bytes,
+         AlertDescription.decode_error, ()),
+        ("cipher suites len fuzz to {0} w/ext", hello_ext, 40, 4,
+         boundary_lengths, AlertDescription.decode_error, valid_ciphers_len),
+        ("compression methods len fuzz to {0} w/ext", hello_ext, 43, 1,
+         boundary_lengths, AlertDescription.decode_error,
+         valid_compression_len),
+        ("extensions len fuzz to {0}", hello_ext, 46, 5, boundary_lengths,
+         AlertDescription.decode_error, ())]
+
+    for name, hello, pos, xor_base, values, description, skip in \
+            single_byte_fuzz:
+        expected = expect_fatal_alert(description)
+        # parse the name template once, not for every test
+        prefix, suffix = name.split("{0}")
+        current = hello[pos]
+        if values is None:
+            values = sorted(set([0, 1, current - 1, current + 1,
+                                 0x7F, 0x80, 0xFE, 0xFF]))
+        for new_value in values:
+            if new_value == current or not 0 <= new_value <= 0xFF:
+                continue
+            if xor_base is None:
+                value = new_value
+                fuzz = {"substitutions": {pos: new_value}}
+            else:
+                # xor_base is not the current value for all Client Hellos
+                # (e.g. with -d), keep the names the same as they have
+                # always been for the sent bytes
+                mask = current ^ new_value
+                value = xor_base ^ mask
+                fuzz = {"xors": {pos: mask}}
+            if value in skip:
+                continue
+            c_name = prefix + str(value) + suffix
+            if c_name in run_exclude:
+                skipped += 1
+            if not is_regular(c_name):
+                continue
+            conversation_factories.append(
+                (c_name,
+                 partial(fuzzed_hello_conversation, host, port, hello,
+                         expected, **fuzz)))
+
+    # test invalid values of two byte lengths
+    # (name, Client Hello, position, values of the high byte)
+    double_byte_fuzz = []
     if not ext:
-        for i in range(1, 0x100):
-            conversation = Connect(host, port)
-            node = conversation
-            hello_gen = ClientHelloGenerator(
-                ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV],
-                version=(3, 3), extensions=ext)
-            node = node.add_child(fuzz_message(hello_gen, xors={40: i}))
-            node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                              description=AlertDescription.decode_error))
-            node = node.add_child(ExpectClose())
-            conversations["cipher suites len fuzz to {0}".format(4 ^ i)] = conversation
-
-        for i in (1, 2, 4, 8, 16, 128, 254, 255):
+        double_byte_fuzz += [
+            ("cipher suites len fuzz to {0}", hello_scsv, 39,
+             (1, 2, 4, 8, 16, 128, 254, 255))]
+    double_byte_fuzz += [
+        ("cipher suites len fuzz to {0} w/ext", hello_ext, 39,
+         (1, 2, 4, 8, 16, 128, 254, 255)),
+        ("extensions len fuzz to {0}", hello_ext, 45,
+         (1, 2, 4, 8, 16, 254, 255))]
+
+    for name, hello, pos, high_values in double_byte_fuzz:
+        expected = expect_fatal_alert(AlertDescription.decode_error)
+        prefix, suffix = name.split("{0}")
+        for i in high_values:
             for j in range(0, 0x100):
-                conversation = Connect(host, port)
-                node = conversation
-                hello_gen = ClientHelloGenerator(
-                    ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV],
-                    version=(3, 3), extensions=ext)
-                node = node.add_child(fuzz_message(hello_gen, substitutions={39: i, 40: j}))
-                node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                                  description=AlertDescription.decode_error))
-                node = node.add_child(ExpectClose())
-                conversations["cipher suites len fuzz to {0}".format((i<<8) + j)] = conversation
-
-    for i in range(1, 0x100):
-        # create valid extension-less ClientHellos
-        if dhe and not ems and i == 56:
-            continue
-        if dhe and ems and i == 60:
-            continue
-        conversation = Connect(host, port)
-        node = conversation
-        hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                         extensions=ext_renego_info)
-        node = node.add_child(fuzz_message(hello_gen, xors={40: i}))
-        node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                          description=AlertDescription.decode_error))
-        node = node.add_child(ExpectClose())
-        conversations["cipher suites len fuzz to {0} w/ext".format(4 ^ i)] = conversation
-
-    for i in (1, 2, 4, 8, 16, 128, 254, 255):
-        for j in range(0, 0x100):
-            conversation = Connect(host, port)
-            node = conversation
-            hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                             extensions=ext_renego_info)
-            node = node.add_child(fuzz_message(hello_gen, substitutions={39: i, 40: j}))
-            node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                              description=AlertDescription.decode_error))
-            node = node.add_child(ExpectClose())
-            conversations["cipher suites len fuzz to {0} w/ext".format((i<<8) + j)] = conversation
-
-    # test invalid sizes for compression methods
-    if not ext:
-        for i in range(1, 0x100):
-            conversation = Connect(host, port)
-            node = conversation
-            hello_gen = ClientHelloGenerator(
-                ciphers + [CipherSuite.TLS_EMPTY_RENEGOTIATION_INFO_SCSV],
-                version=(3, 3), extensions=ext)
-            node = node.add_child(fuzz_message(hello_gen, xors={45: i}))
-            node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                              description=AlertDescription.decode_error))
-            node = node.add_child(ExpectClose())
-            conversations["compression methods len fuzz to {0}".format(1 ^ i)] = conversation
-
-    for i in range(1, 0x100):
-        if not dhe and not ems and 1 ^ i == 8:  # this length creates a valid extension-less hello
-            continue
-        if dhe and not ems and 1 ^ i == 62:
-            continue
-        if dhe and ems and 1 ^ i == 66:
-            continue
-        if not dhe and ems and 1 ^ i == 12:
-            continue
-        conversation = Connect(host, port)
-        node = conversation
-        hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                         extensions=ext_renego_info)
-        node = node.add_child(fuzz_message(hello_gen, xors={43: i}))
-        node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                          description=AlertDescription.decode_error))
-        node = node.add_child(ExpectClose())
-        conversations["compression methods len fuzz to {0} w/ext".format(1 ^ i)] = conversation
-
-    # test invalid sizes for extensions
-    for i in range(1, 0x100):
-        conversation = Connect(host, port)
-        node = conversation
-        hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                         extensions=ext_renego_info)
-        node = node.add_child(fuzz_message(hello_gen, xors={46: i}))
-        node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                          description=AlertDescription.decode_error))
-        node = node.add_child(ExpectClose())
-        conversations["extensions len fuzz to {0}".format(5 ^ i)] = conversation
-
-    for i in (1, 2, 4, 8, 16, 254, 255):
-        for j in range(0, 0x100):
-            conversation = Connect(host, port)
-            node = conversation
-            hello_gen = ClientHelloGenerator(ciphers, version=(3, 3),
-                                             extensions=ext_renego_info)
-            node = node.add_child(fuzz_message(hello_gen, substitutions={45: i, 46: j}))
-            node = node.add_child(ExpectAlert(level=AlertLevel.fatal,
-                                              description=AlertDescription.decode_error))
-            node = node.add_child(ExpectClose())
-            conversations["extensions len fuzz to {0}".format((i<<8)+j)] = conversation
+                c_name = prefix + str((i<<8) + j) + suffix
+                if c_name in run_exclude:
+                    skipped += 1
+                if not is_regular(c_name):
+                    continue
+                conversation_factories.append(
+                    (c_name,
+                     partial(fuzzed_hello_conversation, host, port, hello,
+                             expected, substitutions={pos: i, pos + 1: j})))
 
     # run the conversation
     good = 0
@@ -361,7 +481,7 @@ def main():
     failed = []
     xpassed = []
     if not num_limit:
-        num_limit = len(conversations)
+        num_limit = len(conversation_factories)
 
     # make sure that sanity test is run first and last
     # to verify that server was running and kept running throughout
@@ -369,27 +489,24 @@ def main():
     if run_only:
         if num_limit > len(run_only):
             num_limit = len(run_only)
-        regular_tests = [(k, v) for k, v in conversations.items() if k in run_only]
+
+    # the registry holds only the tests that can be picked, so sample it
+    # directly, without copying it
+    sampled_tests = [(k, v()) for k, v in
+                     sample(conversation_factories,
+                            min(num_limit, len(conversation_factories)))]
+    if jobs > 1:
+        sampled_results = run_conversations_parallel(sampled_tests, jobs)
     else:
-        regular_tests = [(k, v) for k, v in conversations.items() if
-                         (k != 'sanity') and k not in run_exclude]
-    sampled_tests = sample(regular_tests, min(num_limit, len(regular_tests)))
-    ordered_tests = chain(sanity_tests, sampled_tests, sanity_tests)
-
-    for c_name, c_test in ordered_tests:
-        print("{0} ...".format(c_name))
-
-        runner = Runner(c_test)
-
-        res = True
-        exception = None
-        try:
-            runner.run()
-        except Exception as exp:
-            exception = exp
+        sampled_results = run_conversations_serial(sampled_tests)
+    ordered_results = chain(run_conversations_serial(sanity_tests),
+                            sampled_results,
+                            run_conversations_serial(sanity_tests))
+
+    for c_name, res, exception, exc_trace in ordered_results:
+        if not res:
             print("Error while processing")
-            print(traceback.format_exc())
-            res = False
+            print(exc_trace)
 
         if c_name in expected_failures:
             if res:
@@ -419,7 +536,7 @@ def main():
     print("version: {0}".format(version))
     print(20 * '=')
     print("TOTAL: {0}".format(len(sampled_tests) + 2*len(sanity_tests)))
-    print("SKIP: {0}".format(len(run_exclude.intersection(conversations.keys()))))
+    print("SKIP: {0}".format(skipped))
     print("PASS: {0}".format(good))
     print("XFAIL: {0}".format(xfail))
     print("FAIL: {0}".format(bad))